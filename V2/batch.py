@@ -0,0 +1,84 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import numpy as np
+from generateur import Chunkmap, TileIndex, generator
+
+# python batch.py --seeds 0:1000 --size 256x160 --out worlds
+
+
+def get_seeds(text):
+    # "0:1000" or "1,5,9"
+    if ':' in text:
+        start, stop = text.split(':')
+        return list(range(int(start), int(stop)))
+    return [int(seed) for seed in text.split(',')]
+
+
+def get_size(text):
+    # height x width, in tiles
+    height, width = text.lower().split('x')
+    return int(height), int(width)
+
+
+def build(seed, size, out):
+    t0 = time.perf_counter()
+    map_generator = generator(np.full((1, *size), 602, dtype=np.uint16), seed)
+    t1 = time.perf_counter()
+
+    path = os.path.join(out, f'world_{seed}.map')
+    chunkmap = Chunkmap.from_array(map_generator.map)
+    chunkmap.save(path)
+    t2 = time.perf_counter()
+
+    # ores of the world, to check their balance from one seed to the next
+    index = TileIndex(chunkmap)
+    ores = {name: index.get_count(tile) for name, tile in generator.ores.items()}
+    return {'seed': seed, 'path': path, 'generate': t1-t0, 'save': t2-t1, 'bytes': os.path.getsize(path), 'pid': os.getpid(), 'ores': ores}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate worlds without a window, one process per core.')
+    parser.add_argument('--seeds', type=get_seeds, required=True, help='range "start:stop" or list "1,5,9"')
+    parser.add_argument('--size', type=get_size, default=(256, 160), help='height x width in tiles (default 256x160)')
+    parser.add_argument('--out', required=True, help='output directory')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='worker processes (default: all cores)')
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    seeds = args.seeds
+    chunksize = max(1, len(seeds)//(args.workers*8))
+
+    start = time.perf_counter()
+    stats = []
+    with ProcessPoolExecutor(args.workers) as executor:
+        for stat in executor.map(build, seeds, [args.size]*len(seeds), [args.out]*len(seeds), chunksize=chunksize):
+            stats.append(stat)
+            print(f"seed {stat['seed']}: generate {stat['generate']*1000:.1f} ms, save {stat['save']*1000:.1f} ms, {stat['bytes']} bytes")
+    elapsed = time.perf_counter()-start
+
+    summary = {
+        'size': args.size,
+        'workers': args.workers,
+        'worlds': len(stats),
+        'elapsed': elapsed,
+        'worlds_per_second': len(stats)/elapsed if elapsed else 0,
+        'generate': sum(stat['generate'] for stat in stats),
+        'save': sum(stat['save'] for stat in stats),
+        'bytes': sum(stat['bytes'] for stat in stats),
+        'ores': {name: sum(stat['ores'][name] for stat in stats) for name in generator.ores},
+        'stats': stats,
+    }
+    with open(os.path.join(args.out, 'stats.json'), 'w') as file:
+        json.dump(summary, file, indent=2)
+
+    print(f"{len(stats)} worlds in {elapsed:.2f} s with {args.workers} workers ({summary['worlds_per_second']:.1f} worlds/s)")
+
+
+if __name__ == '__main__':
+    main()
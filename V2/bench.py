@@ -0,0 +1,196 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import numpy as np
+import pygame
+from generateur import Chunkmap, Game, Tilemap, Tileset, generator
+
+# python bench.py --out bench.json
+# python bench.py --baseline bench.json
+
+
+def get_sizes(text):
+    # "32x32,256x256": height x width, in tiles
+    return [tuple(int(n) for n in size.lower().split('x')) for size in text.split(',')]
+
+
+def get_layers(text):
+    return [int(layers) for layers in text.split(',')]
+
+
+def measure(function, repeat, setup=None):
+    # one run first, not timed: the first call pays for caches and imports
+    if setup is not None:
+        setup()
+    function()
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        t0 = time.perf_counter()
+        function()
+        times.append(time.perf_counter()-t0)
+    return {'min': min(times), 'median': statistics.median(times), 'mean': statistics.fmean(times), 'runs': repeat}
+
+
+def get_world(size, layers, seed):
+    # layer 0 generated, the next layers almost empty like overlays
+    world = np.full((layers, *size), 602, dtype=np.uint16)
+    world[:1] = generator(world[:1].copy(), seed).map
+    random = np.random.RandomState(seed)
+    for layer in world[1:]:
+        layer[random.random_sample(size) < 0.05] = 420
+    return world
+
+
+def bench_map(tileset, screen, size, layers, repeat, seed, folder):
+    results = {}
+    name = f'{size[0]}x{size[1]}x{layers}'
+    world = get_world(size, layers, seed)
+
+    tilemap = Tilemap(tileset, size=size)
+    tilemap.set_map(Chunkmap.from_array(world, dtype=tilemap.dtype))
+    tilemap.overlay = layers-1
+    random = np.random.RandomState(seed)
+
+    def render():
+        tilemap.render()
+        tilemap.blit(screen)
+
+    def modify():
+        i, j = random.randint(0, size[0]-16), random.randint(0, size[1]-16)
+        tilemap.set_modify([(tilemap.overlay, i+di, j+dj) for di in range(16) for dj in range(16)], 168)
+
+    def scale():
+        tilemap.set_scale(1.2)
+        tilemap.blit(screen)
+
+    results[f'render/{name}'] = measure(render, repeat)
+    results[f'frame/{name}'] = measure(lambda: tilemap.blit(screen), repeat)
+    results[f'set_modify/{name}'] = measure(modify, repeat)
+    results[f'back/{name}'] = measure(tilemap.back, repeat, setup=modify)
+    results[f'set_scale/{name}'] = measure(scale, repeat, setup=lambda: tilemap.set_scale(1/1.2))
+
+    path = os.path.join(folder, f'{name}.map')
+    chunkmap = Chunkmap.from_array(world)
+    results[f'save/{name}'] = measure(lambda: chunkmap.save(path), repeat)
+    results[f'load/{name}'] = measure(lambda: Chunkmap.load(path).to_array(), repeat)
+    return results
+
+
+def get_shaft(size):
+    # one cell wide vertical shafts joined in turn at the top and the bottom:
+    # a single region made of many short horizontal runs
+    mask = np.zeros(size, dtype=bool)
+    mask[:, ::2] = True
+    mask[-1, 1::4] = True
+    mask[0, 3::4] = True
+    return mask
+
+
+def bench_fill(tileset, size, repeat):
+    results = {}
+    name = f'{size[0]}x{size[1]}'
+    tilemap = Tilemap(tileset, size=size)
+    for shape, mask in (('open', np.ones(size, dtype=bool)), ('shaft', get_shaft(size))):
+        world = np.where(mask, 602, 308)[None]
+        tilemap.set_map(Chunkmap.from_array(world, dtype=tilemap.dtype))
+        results[f'get_region/{shape}/{name}'] = measure(lambda: tilemap.get_region(mask, 0, 0), repeat)
+        # every run fills the region again, the previous fill is undone first
+        results[f'set_fill/{shape}/{name}'] = measure(lambda: tilemap.set_fill(0, 0, 0, 168), repeat, setup=tilemap.back)
+    return results
+
+
+def bench_generator(size, repeat, seed):
+    results = {}
+    name = f'{size[0]}x{size[1]}'
+    results[f'generate/{name}'] = measure(lambda: generator(np.full((1, *size), 602, dtype=np.uint16), seed), repeat)
+
+    map_generator = generator(np.full((1, *size), 602, dtype=np.uint16), seed)
+    results[f'plain/{name}'] = measure(map_generator.plain, repeat, setup=lambda: map_generator.map.fill(602))
+    return results
+
+
+def compare(results, baseline, tolerance, floor):
+    # best runs slower than the baseline by more than tolerance and by more
+    # than floor seconds: the best run is the one least disturbed by the
+    # machine, and short measures jitter by a fraction of a millisecond
+    regressions = []
+    for key in sorted(results.keys() & baseline.keys()):
+        new, old = results[key]['min'], baseline[key]['min']
+        ratio = new/old if old else float('inf')
+        flag = ratio > 1+tolerance and new-old > floor
+        if flag:
+            regressions.append(key)
+        print(f"{key:32} {old*1000:10.3f} ms -> {new*1000:10.3f} ms  x{ratio:5.2f}{'  REGRESSION' if flag else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the hot paths of the map without a window.')
+    parser.add_argument('--sizes', type=get_sizes, default=get_sizes('32x32,128x128,256x256,512x512,1024x1024'),
+                        help='map sizes, height x width in tiles (default 32x32 up to 1024x1024)')
+    parser.add_argument('--layers', type=get_layers, default=[1, 4], help='layer counts (default 1,4)')
+    parser.add_argument('--repeat', type=int, default=15, help='runs of each measure, the best one is compared (default 15)')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the generated maps (default 1)')
+    parser.add_argument('--out', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON file of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='slowdown allowed against the baseline (default 0.5)')
+    parser.add_argument('--floor', type=float, default=1.0, help='slowdown in ms below which a measure never fails (default 1)')
+    args = parser.parse_args()
+
+    out = os.path.abspath(args.out) if args.out else None
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    # the textures are looked up next to the script
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    pygame.init()
+    screen = pygame.display.set_mode(Game.screen_size)
+    tileset = Tileset(Game.file)
+
+    results = {}
+    results['Tileset'] = measure(lambda: Tileset(Game.file), args.repeat)
+    results['Tileset.load'] = measure(tileset.load, args.repeat)
+    with tempfile.TemporaryDirectory() as folder:
+        for size in args.sizes:
+            results.update(bench_generator(size, args.repeat, args.seed))
+            results.update(bench_fill(tileset, size, args.repeat))
+            for layers in args.layers:
+                results.update(bench_map(tileset, screen, size, layers, args.repeat, args.seed, folder))
+                print(f'{size[0]}x{size[1]}x{layers} done', file=sys.stderr)
+    pygame.quit()
+
+    report = {
+        'python': platform.python_version(),
+        'pygame': pygame.version.ver,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'repeat': args.repeat,
+        'results': results,
+    }
+    if out:
+        with open(out, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if baseline:
+        with open(baseline) as file:
+            regressions = compare(results, json.load(file)['results'], args.tolerance, args.floor/1000)
+        if regressions:
+            print(f'{len(regressions)} regressions: {", ".join(regressions)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,12 +6,110 @@ import importlib.util
 import sys
 from pygame.locals import *
 import numpy as np
+import zlib
+import hashlib
+import json
+import threading
+import time
+import mmap
+import os
+import shutil
+import struct
+import tempfile
 from math import *
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+class Profiler:
+
+    trace_size = 100000 # trace events kept
+
+    def __init__(self):
+        self.enabled = False
+        self.font = None
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.timers = {} # name -> [calls, seconds, seconds of the last call]
+        self.trace = deque(maxlen=self.trace_size)
+        self.origin = time.perf_counter()
+
+    def set_enabled(self, enabled):
+        if enabled and not self.enabled:
+            self.reset()
+        self.enabled = enabled
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def start(self):
+        # None when disabled: stop() then returns at once
+        return time.perf_counter() if self.enabled else None
+
+    def stop(self, name, start):
+        # returns the end time, the start of a following phase
+        if start is None:
+            return None
+        end = time.perf_counter()
+        duration = end - start
+        timer = self.timers.setdefault(name, [0, 0.0, 0.0])
+        timer[0] += 1
+        timer[1] += duration
+        timer[2] = duration
+        self.trace.append((name, start, duration, threading.get_ident()))
+        return end
+
+    def frame(self):
+        # counters are sampled in the trace once per frame
+        self.trace.append(('counters', time.perf_counter(), None, dict(self.counters)))
+
+    def get_lines(self):
+        lines = [f'{name:22} {calls:6} {total*1000:9.1f} ms {last*1000:8.2f} ms'
+                 for name, (calls, total, last) in sorted(self.timers.items())]
+        lines += [f'{name:22} {value}' for name, value in sorted(self.counters.items())]
+        return lines
+
+    def draw(self, surface, stats):
+        # overlay in the top left corner, returns the rect it covers
+        if self.font is None:
+            self.font = pygame.font.Font(None, 18)
+        lines = [' '.join(f'{key}:{value}' for key, value in stats.items())] + self.get_lines()
+        images = [self.font.render(line, True, (255, 255, 255)) for line in lines]
+        rect = pygame.Rect(0, 0, max(image.get_width() for image in images)+8, sum(image.get_height() for image in images)+8)
+        surface.fill((0, 0, 0), rect)
+        y = 4
+        for image in images:
+            surface.blit(image, (4, y))
+            y += image.get_height()
+        return rect
+
+    def save(self, path):
+        # chrome://tracing and Perfetto format, times in microseconds
+        events = []
+        for name, start, duration, data in self.trace:
+            if duration is None:
+                events.append({'name': name, 'ph': 'C', 'ts': (start-self.origin)*1e6, 'pid': os.getpid(), 'args': data})
+            else:
+                events.append({'name': name, 'ph': 'X', 'ts': (start-self.origin)*1e6, 'dur': duration*1e6,
+                               'pid': os.getpid(), 'tid': data})
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': events}, file)
+
+
+profiler = Profiler()
+
 
 class Game:
 
     file = 'minecraft'
     screen_size = (1400,600)
+    camera_mode = 'chunk' # 'chunk': cached chunk surfaces, 'tile': visible tiles only
+    fps = 60 # frames per second at most
+    scroll_delay = 250 # ms before a held camera key repeats
+    scroll_rate = 20 # cells per second while a camera key is held
+    scroll_keys = {K_z: (1, 0), K_s: (-1, 0), K_q: (0, -1), K_d: (0, 1)}
+    trace_path = 'game_1/trace.json'
     
     def __init__(self):
 
@@ -19,6 +117,12 @@ class Game:
         self.screen = pygame.display.set_mode(self.screen_size)
         pygame.display.set_caption("Pygame Tiled Demo")
         self.running = True
+        self.clock = pygame.time.Clock()
+        self.frames = deque(maxlen=2*self.fps) # (frame ms, busy ms) of the last frames
+        self.held = {} # camera key -> tick of its next repeat
+        self.start = None # map cell under the mouse button press
+        self.selection = None # (layer, i0, j0, i1, j1) of map cells waiting for a tile from the menu
+        self.hud = pygame.Rect(0, 0, 0, 0) # screen covered by the profiler overlay
 
         self.tileset = Tileset(self.file)
 
@@ -31,6 +135,7 @@ class Game:
         self.camera_pos = [75, 8]
 
         self.camera(self.map)
+        self.display()
 
         del self.tileset
 
@@ -55,11 +160,24 @@ class Game:
                     elif event.key == K_g:
                         self.map.grid_activate = False if self.map.grid_activate else True
                         self.menu.grid_activate = False if self.menu.grid_activate else True
-                        self.map.render()
-                        self.menu.render()
                         self.camera(self.map)
                     elif event.key == K_p:
                         self.map.back()
+                    elif event.key == K_o:
+                        self.map.forward()
+                    elif event.key == K_i:
+                        print(self.map.get_memory())
+                    elif event.key == K_f:
+                        print(self.get_stats())
+                    elif event.key == K_F3:
+                        profiler.set_enabled(not profiler.enabled)
+                        self.camera(self.scene)
+                    elif event.key == K_F4:
+                        os.makedirs(os.path.dirname(self.trace_path), exist_ok=True)
+                        profiler.save(self.trace_path)
+                        print(self.trace_path)
+                    elif event.key == K_w:
+                        self.map.set_stream()
                         self.camera(self.map)
                     elif event.key == K_3:
                         self.map.new_save()
@@ -77,77 +195,246 @@ class Game:
                         self.map.set_scale(0.8)
                         self.menu.set_scale(0.8)
                         self.camera(self.map)
-                    elif event.key == K_z:
-                        self.camera_pos[0] += 1
-                        self.camera(self.map)
-                    elif event.key == K_s:
-                        self.camera_pos[0] -= 1
-                        self.camera(self.map)
-                    elif event.key == K_q:
-                        self.camera_pos[1] -= 1
-                        self.camera(self.map)
-                    elif event.key == K_d:
-                        self.camera_pos[1] += 1
+                    elif event.key in self.scroll_keys:
+                        self.set_camera(*self.scroll_keys[event.key])
+                        self.held[event.key] = pygame.time.get_ticks() + self.scroll_delay
+                    elif event.key == K_t:
+                        self.camera_mode = 'tile' if self.camera_mode == 'chunk' else 'chunk'
                         self.camera(self.map)
                     elif event.key == K_UP:
                         self.map.set_overlay(1)
                     elif event.key == K_DOWN:
                         self.map.set_overlay(-1)
+                    elif event.key == K_ESCAPE and self.selection is not None:
+                        self.selection = None
+                        self.camera(self.map)
 
+                elif event.type == KEYUP:
+                    self.held.pop(event.key, None)
+
+                elif event.type == MOUSEBUTTONDOWN:
+                    if self.selection is None or self.scene is not self.menu:
+                        self.start = self.map.get_pos()
+                    else:
+                        # the menu is shown: the clicked tile fills the selection
+                        x, y = self.menu.get_pos()
+                        tile = x*self.menu.sprite_size[1]+y
+                        print(tile)
+                        self.map.set_rect(*self.selection, tile)
+                        self.camera(self.map)
+
+                elif event.type == MOUSEBUTTONUP:
+                    if self.start is not None:
+                        x0, y0 = self.start
+                        x1, y1 = self.map.get_pos()
+                        self.start = None
+                        self.selection = (self.map.overlay, min(x0, x1), min(y0, y1), max(x0, x1)+1, max(y0, y1)+1)
+                        self.camera(self.menu)
+                    else:
+                        self.selection = None
 
-                if event.type == pygame.MOUSEBUTTONDOWN:
-                    x0, y0 = self.map.get_pos()
-                    event_happened = False
-                    while not event_happened:
-                        event = pygame.event.wait()
-                        if event.type == pygame.MOUSEBUTTONUP:
-                            x1, y1 = self.map.get_pos()
-                            tile_pos = []
-                            for i in range(x1-x0 if x1 < x0 else 0, x1-x0+1 if x1 > x0 else 1):
-                                for j in range(y1-y0 if y1 < y0 else 0, y1-y0+1 if y1 > y0 else 1):
-                                    tile_pos.append((self.map.overlay,x0+i, y0+j))
-
-                            self.camera(self.menu)
-
-                            while not event_happened:
-                                event = pygame.event.wait()
-                                if event.type == pygame.MOUSEBUTTONDOWN:
-                                    x, y = self.menu.get_pos()
-                                    tile = x*self.menu.sprite_size[1]+y
-                                    print(tile)
-                                    self.map.set_modify(tile_pos, tile)
-                                    self.camera(self.map)
-                                elif event.type == pygame.MOUSEBUTTONUP:
-                                    event_happened = True
-                                elif event.type == KEYDOWN and event.key == pygame.K_ESCAPE:
-                                    event_happened = True
-                                    self.camera(self.map)
+            self.set_scroll()
+            busy = self.display()
+            self.frames.append((self.clock.tick(self.fps), busy))
 
+        if isinstance(self.map.map, Streammap):
+            # removes the swap folder of the infinite world
+            self.map.map.close()
         pygame.quit()
 
+    def set_camera(self, di, dj):
+        self.camera_pos[0] += di
+        self.camera_pos[1] += dj
+        self.camera(self.map)
+
+    def set_scroll(self):
+        # held camera keys move the view at scroll_rate, once per frame at most
+        now = pygame.time.get_ticks()
+        for key, tick in self.held.items():
+            steps = 0
+            while tick <= now:
+                tick += 1000/self.scroll_rate
+                steps += 1
+            if steps:
+                self.held[key] = tick
+                di, dj = self.scroll_keys[key]
+                self.set_camera(di*steps, dj*steps)
+
     def camera(self, tilemap):
+        # the whole screen is redrawn on the next frame; leaving the menu
+        # drops the selection waiting for a tile
+        self.scene = tilemap
+        self.full = True
+        if tilemap is not self.menu:
+            self.selection = None
+
+    def display(self):
+        # draw the frame once, whatever the number of events behind it,
+        # and push only what changed to the screen
+        start = pygame.time.get_ticks()
+        timer = profiler.start()
+        tilemap = self.scene
+        if tilemap is self.map:
+            tilemap.view = (tilemap.map.shape[1]-self.camera_pos[0], self.camera_pos[1])
+
+        damage = tilemap.get_damage()
+        if self.full or damage is None:
+            self.full = False
+            rects = None
+            pygame.display.set_caption(f'size:{tilemap.get_size()}')
+        else:
+            if profiler.enabled:
+                damage.append(self.hud)
+            rects = [rect.clip(self.screen.get_rect()) for rect in damage]
+            rects = [rect for rect in rects if rect.width and rect.height]
+            if not rects:
+                return 0
+            self.screen.set_clip(rects[0].unionall(rects[1:]))
 
         self.screen.fill((0, 0, 0))
+        if self.camera_mode == 'tile':
+            tilemap.blit_tiles(self.screen)
+        else:
+            tilemap.blit(self.screen)
+        self.screen.set_clip(None)
+
+        if profiler.enabled:
+            profiler.stop('Game.display', timer)
+            profiler.frame()
+            self.hud = profiler.draw(self.screen, self.get_stats())
+            if rects is not None:
+                rects.append(self.hud)
+
+        if rects is None:
+            pygame.display.update()
+        else:
+            pygame.display.update(rects)
+        return pygame.time.get_ticks() - start
+
+    def get_stats(self):
+        # frame times over the last frames, in ms
+        if not self.frames:
+            return {}
+        frames, busy = zip(*self.frames)
+        return {
+            'fps': round(self.clock.get_fps(), 1),
+            'frame': round(sum(frames)/len(frames), 2),
+            'frame_max': max(frames),
+            'busy': round(sum(busy)/len(busy), 2),
+            'busy_max': max(busy),
+        }
+
+
+class TileAtlas(dict):
+    def __init__(self, image, rects):
+        super().__init__()
+        self.image = image
+        self.rects = rects
+
+    def __len__(self):
+        return len(self.rects)
+
+    def __missing__(self, tile):
+        # a view into the atlas, made the first time the tile is used: no copy
+        view = self.image.subsurface(self.rects[tile])
+        self[tile] = view
+        return view
+
+
+class TileCache(dict):
+    def __init__(self, tiles, size):
+        super().__init__()
+        self.tiles = tiles
+        self.size = size
+
+    def __missing__(self, tile):
+        # scale a tile only the first time it is drawn at this zoom level
+        if self.size == self.tiles.rects[tile].size:
+            scaled = self.tiles[tile]
+        else:
+            scaled = pygame.transform.scale(self.tiles[tile], self.size)
+            if profiler.enabled:
+                profiler.count('scale')
+        self[tile] = scaled
+        return scaled
 
-        self.rect = tilemap.image.get_rect()
 
-        self.screen = pygame.display.set_mode(self.screen_size)
-        pygame.display.set_caption(f'size:{self.rect.size}')
-        self.screen.blit(tilemap.image, self.rect, (self.camera_pos[1]*16*tilemap.resize,(256-self.camera_pos[0])*16*tilemap.resize , self.screen_size[0]*tilemap.resize, self.screen_size[1]*tilemap.resize))
-        pygame.display.update()
+class Tileset:
 
+    cache_size = 4 # zoom levels kept in memory
+
+    # atlas file: header, tile rects, atlas pixels as converted for the display
+    atlas_magic = b'TILES\0'
+    atlas_header = struct.Struct('<6sH20s20sHHIIHHIIIH')
 
-class Tileset:
     def __init__(self, file):
-        self.get_info(file)
-        self.image = pygame.image.load(self.file).convert_alpha()
+        self.cache = OrderedDict()
+        if not self.get_atlas(file):
+            self.get_info(file)
+            self.image = pygame.image.load(self.file).convert_alpha()
+            self.rect = self.image.get_rect()
+            self.tiles = TileAtlas(self.image, [])
+            self.load()
+            self.set_atlas(file)
+
+    def get_path(self, file):
+        return "texture/" + file + "/" + file + "_const.py", "texture/" + file + "/" + file + ".tiles"
+
+    def get_digest(self, path):
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).digest()
+
+    def get_atlas(self, file):
+        # tiles prepared by an earlier launch, if neither source file changed
+        start = profiler.start()
+        const, path = self.get_path(file)
+        try:
+            with open(path, 'rb') as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            (magic, version, const_digest, image_digest, sw, sh, width, height, margin, spacing,
+             iw, ih, count, length) = self.atlas_header.unpack_from(buffer)
+            offset = self.atlas_header.size
+            name = bytes(buffer[offset:offset+length]).decode()
+            if (magic != self.atlas_magic or version != 1 or const_digest != self.get_digest(const)
+                    or image_digest != self.get_digest(name)):
+                return False
+        except (OSError, ValueError, struct.error):
+            return False
+
+        offset += length
+        rects = np.frombuffer(buffer, dtype='<i4', count=4*count, offset=offset).reshape(count, 4)
+        offset += rects.nbytes
+        self.buffer = buffer
+        self.image = pygame.image.frombuffer(memoryview(buffer)[offset:offset+4*iw*ih], (iw, ih), 'BGRA')
         self.rect = self.image.get_rect()
-        self.tiles = []
-        self.load()
-    
+        self.tiles = TileAtlas(self.image, [pygame.Rect(*rect) for rect in rects.tolist()])
+
+        self.file = name
+        self.sprite_size = (sw, sh)
+        self.size = (width, height)
+        self.margin = margin
+        self.spacing = spacing
+        profiler.stop('Tileset.get_atlas', start)
+        return True
+
+    def set_atlas(self, file):
+        const, path = self.get_path(file)
+        name = self.file.encode()
+        rects = np.array([tuple(rect) for rect in self.tiles.rects], dtype='<i4').reshape(-1, 4)
+        header = self.atlas_header.pack(self.atlas_magic, 1, self.get_digest(const), self.get_digest(self.file),
+                                        *self.sprite_size, *self.size, self.margin, self.spacing,
+                                        *self.rect.size, len(rects), len(name))
+        try:
+            with open(path+'.tmp', 'wb') as f:
+                f.write(header + name + rects.tobytes() + pygame.image.tobytes(self.image, 'BGRA'))
+            os.replace(path+'.tmp', path)
+        except OSError:
+            # read-only texture folder: the tiles are prepared again next time
+            pass
+
     def get_info(self, file):
 
-        spec = importlib.util.spec_from_file_location("const","texture/" + file + "/" + file + "_const.py")
+        spec = importlib.util.spec_from_file_location("const", self.get_path(file)[0])
         const = importlib.util.module_from_spec(spec)
         sys.modules["const"] = const
         spec.loader.exec_module(const)
@@ -159,31 +446,715 @@ class Tileset:
         self.spacing = const.SPACING
 
     def load(self):
-
-        self.tiles = []
+        # only the place of each tile is computed, see TileAtlas
+        start = profiler.start()
         x0 = y0 = self.margin
         w, h = self.rect.size
         dx = self.sprite_size[0] + self.spacing
         dy = self.sprite_size[1] + self.spacing
 
-        for y in range(x0, w, dx):
-            for x in range(y0, h, dy):
-                tile = pygame.Surface((self.sprite_size[0],self.sprite_size[1])).convert_alpha()
-                tile.blit(self.image, (0, 0), (x, y, *(self.sprite_size[0],self.sprite_size[1])))
-                self.tiles.append(tile)
+        rects = [pygame.Rect(x, y, *self.sprite_size) for y in range(x0, w, dx) for x in range(y0, h, dy)]
+        self.tiles = TileAtlas(self.image, rects)
+        self.cache.clear()
+        profiler.stop('Tileset.load', start)
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def get_size(self, resize):
+        return ceil(self.sprite_size[0]*resize), ceil(self.sprite_size[1]*resize)
+
+    def get_scale(self, resize):
+        size = self.get_size(resize)
+        if size in self.cache:
+            self.cache.move_to_end(size)
+        else:
+            self.cache[size] = TileCache(self.tiles, size)
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return self.cache[size]
+
+    def get_dtype(self):
+        # smallest unsigned type holding every tile id
+        for dtype in (np.uint8, np.uint16, np.uint32):
+            if len(self) <= np.iinfo(dtype).max+1:
+                return np.dtype(dtype)
+        return np.dtype(np.uint64)
+
+    def get_memory(self):
+        # views into the atlas own no pixels
+        return sum(tile.get_pitch()*tile.get_height() for cache in self.cache.values()
+                   for tile in cache.values() if tile.get_parent() is None)
 
     def __str__(self):
         return f'{self.__class__.__name__} file:{self.file} tile:{self.sprite_size}'
 
+class Chunkmap:
+
+    chunk_size = 32
+    budget = 256 # chunks kept unpacked in memory
+    level = 1 # zlib level of packed chunks
+
+    # save file: header, index of (ci, cj, offset, length), compressed chunks
+    magic = b'MAP2D\0'
+    header = struct.Struct('<6sHqqHHI8sI')
+    entry = np.dtype([('ci', '<i8'), ('cj', '<i8'), ('offset', '<u8'), ('length', '<u4')])
+
+    def __init__(self, size, layers=1, fill=602, dtype=np.uint16):
+        self.size = tuple(size)
+        self.layers = layers
+        self.fill = fill
+        self.dtype = np.dtype(dtype)
+        self.chunks = OrderedDict()
+        self.packed = {}
+        self.source = None # (buffer, index) of a memory-mapped save
+
+    @classmethod
+    def from_array(cls, array, fill=602, dtype=None):
+        array = array if dtype is None else array.astype(dtype, copy=False)
+        chunkmap = cls(array.shape[1:], array.shape[0], fill, array.dtype)
+        cs = cls.chunk_size
+        for ci in range(ceil(array.shape[1]/cs)):
+            for cj in range(ceil(array.shape[2]/cs)):
+                block = array[:, ci*cs:(ci+1)*cs, cj*cs:(cj+1)*cs]
+                if (block == fill).all():
+                    continue
+                chunk = np.full((array.shape[0], cs, cs), fill, dtype=array.dtype)
+                chunk[:, :block.shape[1], :block.shape[2]] = block
+                chunkmap.set_chunk((ci, cj), chunk)
+        return chunkmap
+
+    @property
+    def shape(self):
+        return (self.layers, *self.size)
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.to_array()
+        return array if dtype is None else array.astype(dtype)
+
+    def to_array(self):
+        return self[:, :, :]
+
+    def add_layer(self):
+        # chunks are padded with the empty tile the next time they are read
+        self.layers += 1
+
+    def remove_layer(self):
+        # chunks are cut the next time they are read
+        self.layers -= 1
+
+    def get_chunk(self, key):
+        if key in self.chunks:
+            self.chunks.move_to_end(key)
+            chunk = self.chunks[key]
+        elif key in self.packed:
+            chunk = self.unpack(self.packed.pop(key))
+            self.set_chunk(key, chunk)
+        elif self.in_source(key):
+            offset, length = self.source[1][key]
+            chunk = self.unpack(self.source[0][offset:offset+length])
+            self.set_chunk(key, chunk)
+        else:
+            return None
+
+        if chunk.shape[0] < self.layers:
+            empty = np.full((self.layers-chunk.shape[0], *chunk.shape[1:]), self.fill, dtype=self.dtype)
+            chunk = np.concatenate((chunk, empty))
+            self.chunks[key] = chunk
+        elif chunk.shape[0] > self.layers:
+            chunk = self.chunks[key] = chunk[:self.layers]
+        return chunk
+
+    def set_chunk(self, key, chunk):
+        self.packed.pop(key, None)
+        self.chunks[key] = chunk
+        self.chunks.move_to_end(key)
+
+        # least recently used chunks are compressed, empty ones are dropped
+        while len(self.chunks) > self.budget:
+            old, array = self.chunks.popitem(last=False)
+            if self.in_source(old) or not (array == self.fill).all():
+                self.packed[old] = zlib.compress(array.tobytes(), self.level)
+
+    def read_chunk(self, key):
+        # the chunk as stored, read without unpacking it for good: None when
+        # it was never written
+        if key in self.chunks:
+            return self.chunks[key]
+        if key in self.packed:
+            return self.unpack(self.packed[key])
+        if self.in_source(key):
+            offset, length = self.source[1][key]
+            return self.unpack(self.source[0][offset:offset+length])
+        return None
+
+    def get_keys(self):
+        # chunks written at least once
+        keys = self.chunks.keys() | self.packed.keys()
+        return keys | self.source[1].keys() if self.source is not None else keys
+
+    def unpack(self, blob):
+        cs = self.chunk_size
+        return np.frombuffer(bytearray(zlib.decompress(blob)), dtype=self.dtype).reshape(-1, cs, cs)
+
+    def in_source(self, key):
+        return self.source is not None and key in self.source[1]
+
+    def new_chunk(self, key):
+        chunk = self.get_chunk(key)
+        if chunk is None:
+            cs = self.chunk_size
+            chunk = np.full((self.layers, cs, cs), self.fill, dtype=self.dtype)
+            self.set_chunk(key, chunk)
+        return chunk
+
+    def get_chunks(self, i0, j0, i1, j1):
+        cs = self.chunk_size
+        for ci in range(i0//cs, (i1-1)//cs+1):
+            for cj in range(j0//cs, (j1-1)//cs+1):
+                yield (ci, cj), (max(i0, ci*cs), max(j0, cj*cs), min(i1, (ci+1)*cs), min(j1, (cj+1)*cs))
+
+    def get_key(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        return key + (slice(None),)*(3-len(key))
+
+    def get_range(self, index, axis):
+        size = self.size[axis-1]
+        if isinstance(index, slice):
+            start, stop, _ = index.indices(size)
+            return start, max(start, stop), False
+        index = int(index)
+        index = index+size if index < 0 else index
+        return index, index+1, True
+
+    def __getitem__(self, key):
+        layer, rows, cols = self.get_key(key)
+        if not (isinstance(rows, slice) or np.isscalar(rows)) or not (isinstance(cols, slice) or np.isscalar(cols)):
+            return self.get_cells(layer, rows, cols)
+
+        i0, i1, squeeze_i = self.get_range(rows, 1)
+        j0, j1, squeeze_j = self.get_range(cols, 2)
+        cells = np.full((self.layers, i1-i0, j1-j0), self.fill, dtype=self.dtype)
+        if i0 < i1 and j0 < j1:
+            for (ci, cj), (a0, b0, a1, b1) in self.get_chunks(i0, j0, i1, j1):
+                chunk = self.get_chunk((ci, cj))
+                if chunk is not None:
+                    cs = self.chunk_size
+                    cells[:, a0-i0:a1-i0, b0-j0:b1-j0] = chunk[:, a0-ci*cs:a1-ci*cs, b0-cj*cs:b1-cj*cs]
+
+        return cells[layer, 0 if squeeze_i else slice(None), 0 if squeeze_j else slice(None)]
+
+    def __setitem__(self, key, value):
+        layer, rows, cols = self.get_key(key)
+        if not (isinstance(rows, slice) or np.isscalar(rows)) or not (isinstance(cols, slice) or np.isscalar(cols)):
+            return self.set_cells(layer, rows, cols, value)
+
+        i0, i1, squeeze_i = self.get_range(rows, 1)
+        j0, j1, squeeze_j = self.get_range(cols, 2)
+        if i0 >= i1 or j0 >= j1:
+            return
+
+        shape = np.empty((self.layers, i1-i0, j1-j0), dtype=bool)[layer, 0 if squeeze_i else slice(None), 0 if squeeze_j else slice(None)].shape
+        value = np.broadcast_to(np.asarray(value, dtype=self.dtype), shape)
+        if squeeze_i and squeeze_j:
+            value = value[..., None, None]
+        elif squeeze_i:
+            value = value[..., None, :]
+        elif squeeze_j:
+            value = value[..., None]
+
+        cs = self.chunk_size
+        for (ci, cj), (a0, b0, a1, b1) in self.get_chunks(i0, j0, i1, j1):
+            chunk = self.new_chunk((ci, cj))
+            chunk[layer, a0-ci*cs:a1-ci*cs, b0-cj*cs:b1-cj*cs] = value[..., a0-i0:a1-i0, b0-j0:b1-j0]
+
+    def get_cells(self, layer, rows, cols):
+        layer, rows, cols = np.broadcast_arrays(layer, rows, cols)
+        cells = np.full(rows.shape, self.fill, dtype=self.dtype)
+        cs = self.chunk_size
+        keys, inverse = np.unique(np.stack((rows//cs, cols//cs)).reshape(2, -1), axis=1, return_inverse=True)
+        inverse = inverse.reshape(rows.shape)
+        for n, (ci, cj) in enumerate(keys.T.tolist()):
+            chunk = self.get_chunk((ci, cj))
+            if chunk is not None:
+                sel = inverse == n
+                cells[sel] = chunk[layer[sel], rows[sel]-ci*cs, cols[sel]-cj*cs]
+        return cells
+
+    def set_cells(self, layer, rows, cols, value):
+        layer, rows, cols, value = np.broadcast_arrays(layer, rows, cols, np.asarray(value, dtype=self.dtype))
+        cs = self.chunk_size
+        keys, inverse = np.unique(np.stack((rows//cs, cols//cs)).reshape(2, -1), axis=1, return_inverse=True)
+        inverse = inverse.reshape(rows.shape)
+        for n, (ci, cj) in enumerate(keys.T.tolist()):
+            sel = inverse == n
+            chunk = self.new_chunk((ci, cj))
+            chunk[layer[sel], rows[sel]-ci*cs, cols[sel]-cj*cs] = value[sel]
+
+    def get_memory(self):
+        return sum(chunk.nbytes for chunk in self.chunks.values()), sum(len(chunk) for chunk in self.packed.values())
+
+    def clip(self, i0, j0, i1, j1):
+        m, n = self.size
+        return max(i0, 0), max(j0, 0), min(i1, m), min(j1, n)
+
+    def set_view(self, j0, j1):
+        # columns on screen, for maps loaded on demand
+        pass
+
+    def get_state(self):
+        # every chunk compressed, as kept by the undo journal
+        packed = dict(self.packed)
+        for key, chunk in self.chunks.items():
+            if self.in_source(key) or not (chunk == self.fill).all():
+                packed[key] = zlib.compress(chunk.tobytes(), self.level)
+        return self.size, self.layers, self.fill, self.dtype, packed, self.source
+
+    @classmethod
+    def from_state(cls, state):
+        size, layers, fill, dtype, packed, source = state
+        chunkmap = cls(size, layers, fill, dtype)
+        chunkmap.packed = dict(packed)
+        chunkmap.source = source
+        return chunkmap
+
+    def save(self, path):
+        packed = self.get_state()[4]
+        if self.source is not None:
+            buffer, index = self.source
+            blobs = {key: buffer[offset:offset+length] for key, (offset, length) in index.items() if key not in packed}
+            blobs.update(packed)
+        else:
+            blobs = packed
+
+        index = np.zeros(len(blobs), dtype=self.entry)
+        index['ci'], index['cj'] = np.array(list(blobs), dtype=np.int64).reshape(-1, 2).T
+        index['length'] = [len(blob) for blob in blobs.values()]
+        index['offset'] = self.header.size + index.nbytes + np.concatenate(([0], np.cumsum(index['length'][:-1], dtype=np.uint64)))
+
+        # written aside then renamed, a map loaded from this file stays readable
+        with open(path+'.tmp', 'wb') as file:
+            file.write(self.header.pack(self.magic, 1, *self.size, self.layers, self.chunk_size,
+                                        self.fill, self.dtype.str.encode(), len(blobs)))
+            file.write(index.tobytes())
+            for blob in blobs.values():
+                file.write(blob)
+        os.replace(path+'.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        # chunks are only read and decompressed when first accessed
+        with open(path, 'rb') as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, _, rows, cols, layers, chunk_size, fill, dtype, count = cls.header.unpack_from(buffer)
+        if magic != cls.magic or chunk_size != cls.chunk_size:
+            raise ValueError(f'{path} is not a map saved with {cls.chunk_size}x{cls.chunk_size} chunks')
+
+        entries = np.frombuffer(buffer, dtype=cls.entry, count=count, offset=cls.header.size)
+        keys = zip(entries['ci'].tolist(), entries['cj'].tolist())
+        blobs = zip(entries['offset'].tolist(), entries['length'].tolist())
+
+        chunkmap = cls((rows, cols), layers, fill, dtype.rstrip(b'\0').decode())
+        chunkmap.source = (buffer, dict(zip(keys, blobs)))
+        return chunkmap
+
+    def __str__(self):
+        return f'{self.__class__.__name__} {self.shape} chunks:{len(self.chunks)} packed:{len(self.packed)}'
+
+
+class Streammap(Chunkmap):
+
+    keep = 8 # chunk columns kept in memory on each side of the view
+    prefetch = 2 # chunk columns generated ahead in the scroll direction
+
+    def __init__(self, height, seed, path=None, layers=1, fill=602, dtype=np.uint16):
+        super().__init__((height, 0), layers, fill, dtype)
+        self.seed = seed
+        self.path = tempfile.mkdtemp(prefix='map2d_') if path is None else path
+        self.columns = set() # chunk columns in memory
+        self.modified = set() # columns changed since they were generated or read
+        self.swapped = set() # columns written to disk
+        self.pending = {}
+        self.executor = ThreadPoolExecutor(1)
+        self.last = None
+
+    def get_range(self, index, axis):
+        if axis == 1 or not isinstance(index, slice):
+            return super().get_range(index, axis)
+        # no left or right edge: the columns are always given explicitly
+        return index.start, max(index.start, index.stop), False
+
+    def clip(self, i0, j0, i1, j1):
+        return max(i0, 0), j0, min(i1, self.size[0]), j1
+
+    def get_chunk(self, key):
+        self.get_column(key[1])
+        return super().get_chunk(key)
+
+    def new_chunk(self, key):
+        self.modified.add(key[1])
+        return super().new_chunk(key)
+
+    def get_column(self, cj):
+        if cj in self.columns:
+            return
+        self.columns.add(cj)
+
+        if cj in self.pending:
+            array = self.pending.pop(cj).result()
+        elif cj in self.swapped:
+            column = Chunkmap.load(self.get_path(cj))
+            buffer, index = column.source
+            for key, (offset, length) in index.items():
+                self.packed[key] = buffer[offset:offset+length]
+            return
+        else:
+            array = self.generate(cj)
+
+        cs = self.chunk_size
+        for ci in range(ceil(self.size[0]/cs)):
+            chunk = array[:, ci*cs:(ci+1)*cs]
+            if not (chunk == self.fill).all():
+                if chunk.shape[1] < cs:
+                    chunk = np.concatenate((chunk, np.full((self.layers, cs-chunk.shape[1], cs), self.fill, dtype=self.dtype)), axis=1)
+                self.set_chunk((ci, cj), chunk)
+
+    def generate(self, cj):
+        cs = self.chunk_size
+        array = np.full((self.layers, self.size[0], cs), self.fill, dtype=self.dtype)
+        generator(array, self.seed, origin=cj*cs)
+        return array
+
+    def set_view(self, j0, j1):
+        cs = self.chunk_size
+        c0, c1 = j0//cs, (j1-1)//cs
+        direction = 0 if self.last is None else c0-self.last
+        self.last = c0
+
+        if direction:
+            ahead = range(c1+1, c1+1+self.prefetch) if direction > 0 else range(c0-self.prefetch, c0)
+            for cj in ahead:
+                if cj not in self.columns and cj not in self.pending and cj not in self.swapped:
+                    self.pending[cj] = self.executor.submit(self.generate, cj)
+
+        for cj in list(self.columns):
+            if not c0-self.keep <= cj <= c1+self.keep:
+                self.evict(cj)
+        for cj in list(self.pending):
+            if not c0-self.keep <= cj <= c1+self.keep:
+                self.pending.pop(cj).cancel()
+
+    def evict(self, cj):
+        blobs = self.get_blobs(cj)
+        for key in list(self.chunks):
+            if key[1] == cj:
+                del self.chunks[key]
+        for key in list(self.packed):
+            if key[1] == cj:
+                del self.packed[key]
+
+        # a column never changed is simply generated again
+        if cj in self.modified:
+            column = Chunkmap((self.size[0], self.chunk_size), self.layers, self.fill, self.dtype)
+            column.packed = blobs
+            column.save(self.get_path(cj))
+            self.swapped.add(cj)
+            self.modified.discard(cj)
+        self.columns.discard(cj)
+
+    def get_blobs(self, cj):
+        if cj not in self.columns and cj in self.swapped:
+            buffer, index = Chunkmap.load(self.get_path(cj)).source
+            return {key: buffer[offset:offset+length] for key, (offset, length) in index.items()}
+
+        blobs = {key: blob for key, blob in self.packed.items() if key[1] == cj}
+        for key, chunk in self.chunks.items():
+            if key[1] == cj and not (chunk == self.fill).all():
+                blobs[key] = zlib.compress(chunk.tobytes(), self.level)
+        return blobs
+
+    def get_path(self, cj):
+        return os.path.join(self.path, f'column_{cj}.map')
+
+    def save(self, path):
+        # the explored part is saved as a finite map
+        known = sorted(self.columns | self.swapped)
+        cs = self.chunk_size
+        chunkmap = Chunkmap((self.size[0], (known[-1]-known[0]+1)*cs), self.layers, self.fill, self.dtype)
+        for cj in known:
+            for (ci, _), blob in self.get_blobs(cj).items():
+                chunkmap.packed[(ci, cj-known[0])] = blob
+        chunkmap.save(path)
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __str__(self):
+        return f'{self.__class__.__name__} {self.shape} columns:{len(self.columns)} swapped:{len(self.swapped)} chunks:{len(self.chunks)} packed:{len(self.packed)}'
+
+
+class Journal:
+
+    memory = 16*2**20 # bytes of history kept
+    checkpoint = 32 # edits kept one by one, older ones are merged
+
+    def __init__(self, memory=None, checkpoint=None):
+        self.memory = self.memory if memory is None else memory
+        self.checkpoint = self.checkpoint if checkpoint is None else checkpoint
+        self.records = []
+        self.redo = []
+
+    def add_cells(self, layer, rows, cols, old, new):
+        index = np.stack(np.broadcast_arrays(layer, rows, cols)).reshape(3, -1).astype(np.int32)
+        old = np.broadcast_to(old, index.shape[1:])
+        new = np.broadcast_to(new, index.shape[1:])
+        changed = old != new
+        if changed.any():
+            self.add(('cells', index[:, changed], old[changed].copy(), new[changed].copy()))
+
+    def add_block(self, layer, i0, j0, old, new):
+        # a rectangle of cells: only the ones that change are kept
+        new = np.broadcast_to(np.asarray(new, dtype=old.dtype), old.shape)
+        rows, cols = np.nonzero(old != new)
+        if len(rows):
+            index = np.stack((np.full_like(rows, layer), rows+i0, cols+j0)).astype(np.int32)
+            self.add(('cells', index, old[rows, cols], new[rows, cols]))
+
+    def add_map(self, old, new):
+        self.add(('map', old, new))
+
+    def add_layers(self, old, new):
+        # layer count before and after: undo drops the layers added
+        self.add(('layers', old, new))
+
+    def add(self, record):
+        if profiler.enabled:
+            profiler.count('undo_bytes', self.get_memory([record]))
+        self.records.append(record)
+        self.redo.clear()
+
+        if len(self.records) >= 2*self.checkpoint:
+            self.compact()
+        while len(self.records) > 1 and self.get_memory() > self.memory:
+            self.records.pop(0)
+
+    def compact(self):
+        # merge the consecutive cell edits older than the last checkpoint
+        records = []
+        for record in self.records[:-self.checkpoint]:
+            if records and records[-1][0] == record[0] == 'cells':
+                records[-1] = self.merge(records[-1], record)
+            else:
+                records.append(record)
+        self.records = records + self.records[-self.checkpoint:]
+
+    def merge(self, first, second):
+        index = np.concatenate((first[1], second[1]), axis=1)
+        old = np.concatenate((first[2], second[2]))
+        new = np.concatenate((first[3], second[3]))
+        # oldest value and newest value of every cell
+        cells, first_seen = np.unique(index, axis=1, return_index=True)
+        _, last_seen = np.unique(index[:, ::-1], axis=1, return_index=True)
+        return ('cells', cells, old[first_seen], new[::-1][last_seen])
+
+    def undo(self):
+        if self.records:
+            record = self.records.pop()
+            self.redo.append(record)
+            return record
+
+    def forward(self):
+        if self.redo:
+            record = self.redo.pop()
+            self.records.append(record)
+            return record
+
+    def get_memory(self, records=None):
+        size = 0
+        for record in self.records if records is None else records:
+            if record[0] == 'cells':
+                size += sum(array.nbytes for array in record[1:])
+            elif record[0] == 'map':
+                size += sum(len(chunk) for state in record[1:] for chunk in state[4].values())
+        return size
+
+    def __len__(self):
+        return len(self.records)
+
+    def __str__(self):
+        return f'{self.__class__.__name__} records:{len(self.records)} redo:{len(self.redo)} bytes:{self.get_memory()}'
+
+
+class TileIndex:
+
+    # cells of each tile per layer and per chunk, kept up to date by the
+    # Tilemap edits: queries read these tables, never the whole map. Only the
+    # tiles met so far get a row, and a chunk is counted the first time a
+    # query needs it, so setting a map reads nothing
+
+    batch = 256 # chunks counted at once
+
+    def __init__(self, chunkmap):
+        self.map = chunkmap
+        self.chunk_size = cs = chunkmap.chunk_size
+        m, n = chunkmap.size
+        self.shape = (ceil(m/cs), ceil(n/cs))
+        # cells of each chunk inside the map
+        self.rows = np.minimum(cs, m - np.arange(self.shape[0])*cs)
+        self.cols = np.minimum(cs, n - np.arange(self.shape[1])*cs)
+        self.slots = {} # tile -> its row in the tables
+        self.table = np.zeros((chunkmap.layers, 0, *self.shape), dtype=np.min_scalar_type(cs*cs))
+        self.counts = np.zeros((chunkmap.layers, 0), dtype=np.int64)
+        self.counted = np.zeros(self.shape, dtype=bool)
+
+    def get_slots(self, tiles):
+        # rows of the tiles, new tiles get a row of zeros
+        unique, inverse = np.unique(tiles, return_inverse=True)
+        new = [tile for tile in unique.tolist() if tile not in self.slots]
+        if new:
+            for tile in new:
+                self.slots[tile] = len(self.slots)
+            self.table = np.concatenate((self.table, np.zeros((self.table.shape[0], len(new), *self.shape), dtype=self.table.dtype)), axis=1)
+            self.counts = np.pad(self.counts, ((0, 0), (0, len(new))))
+        return np.array([self.slots[tile] for tile in unique.tolist()], dtype=np.int64)[inverse].reshape(np.shape(tiles))
+
+    def add_layer(self):
+        # a new layer only holds the empty tile: nothing to read
+        fill = self.get_slots([self.map.fill])[0]
+        layer = np.zeros((1, *self.table.shape[1:]), dtype=self.table.dtype)
+        layer[0, fill] = np.where(self.counted, self.rows[:, None]*self.cols, 0)
+        self.table = np.concatenate((self.table, layer))
+        self.counts = np.concatenate((self.counts, layer.sum(axis=(2, 3), dtype=np.int64)))
+
+    def remove_layer(self):
+        self.table = self.table[:-1]
+        self.counts = self.counts[:-1]
+
+    def set_counted(self):
+        # chunks never counted, from their cells as they are now; the ones
+        # never written only hold the empty tile
+        if self.counted.all():
+            return
+        stored = self.map.get_keys()
+        keys = [key for key in map(tuple, np.argwhere(~self.counted).tolist()) if key in stored]
+        ci, cj = np.nonzero(~self.counted)
+        fill = self.get_slots([self.map.fill])[0]
+        self.table[:, :, ci, cj] = 0
+        self.table[:, fill, ci, cj] = self.rows[ci]*self.cols[cj]
+        for n in range(0, len(keys), self.batch):
+            self.set_chunks(keys[n:n+self.batch])
+        self.counted[:] = True
+        self.counts = self.table.sum(axis=(2, 3), dtype=np.int64)
+
+    def set_chunks(self, keys):
+        cs, layers = self.chunk_size, self.map.layers
+        cells = np.full((len(keys), layers, cs, cs), self.map.fill, dtype=self.map.dtype)
+        inside = np.zeros((len(keys), 1, cs, cs), dtype=bool)
+        for n, (ci, cj) in enumerate(keys):
+            chunk = self.map.read_chunk((ci, cj))
+            cells[n, :chunk.shape[0]] = chunk[:layers]
+            inside[n, :, :self.rows[ci], :self.cols[cj]] = True
+        slots = self.get_slots(cells)
+        size = layers*len(self.slots)
+        ids = (np.arange(len(keys))[:, None, None, None]*layers + np.arange(layers)[:, None, None])*len(self.slots) + slots
+        counts = np.bincount(ids[np.broadcast_to(inside, ids.shape)], minlength=len(keys)*size)
+        ci, cj = np.array(keys).T
+        self.table[:, :, ci, cj] = counts.reshape(len(keys), layers, -1).transpose(1, 2, 0)
+
+    def update(self, layer, rows, cols, old, new):
+        # distinct cells (layer, rows, cols) went from old to new; a chunk
+        # not counted yet will be counted from its new cells
+        layer, rows, cols, old, new = (np.ravel(a) for a in np.broadcast_arrays(layer, rows, cols, old, new))
+        # a negative layer counts from the top, as in Chunkmap
+        layer = layer % self.table.shape[0]
+        cs = self.chunk_size
+        ci, cj = rows//cs, cols//cs
+        keep = (old != new) & self.counted[ci, cj]
+        if not keep.any():
+            return
+        layer, ci, cj, old, new = layer[keep], ci[keep], cj[keep], old[keep], new[keep]
+        old, new = self.get_slots(old), self.get_slots(new)
+
+        # one count of the changes over the chunks they touch
+        i0, j0 = ci.min(), cj.min()
+        h, w = ci.max()-i0+1, cj.max()-j0+1
+        layers, tiles = self.table.shape[:2]
+        cells = ((layer*tiles)*h + ci-i0)*w + cj-j0
+        size = layers*tiles*h*w
+        delta = np.bincount(cells + new*h*w, minlength=size) - np.bincount(cells + old*h*w, minlength=size)
+        delta = delta.reshape(layers, tiles, h, w)
+        block = self.table[:, :, i0:i0+h, j0:j0+w]
+        block[...] = block + delta
+        self.counts += delta.sum(axis=(2, 3))
+
+    def get_layers(self, layer):
+        return slice(None) if layer is None else [layer]
+
+    def get_count(self, tile, layer=None):
+        self.set_counted()
+        if tile not in self.slots:
+            return 0
+        return int(self.counts[self.get_layers(layer), self.slots[tile]].sum())
+
+    def get_presence(self, tile, layer=None):
+        # chunks holding the tile, one boolean per chunk
+        self.set_counted()
+        if tile not in self.slots:
+            return np.zeros(self.shape, dtype=bool)
+        return (self.table[self.get_layers(layer), self.slots[tile]] > 0).any(axis=0)
+
+    def get_chunks(self, tile, layer=None):
+        return [tuple(key) for key in np.argwhere(self.get_presence(tile, layer)).tolist()]
+
+    def get_nearest(self, tile, i, j, layer=None):
+        # only the chunks holding the tile are read, closest first, until no
+        # chunk left can be closer than the best cell found
+        cs = self.chunk_size
+        keys = np.argwhere(self.get_presence(tile, layer))
+        di = np.maximum(np.maximum(keys[:, 0]*cs - i, i - (keys[:, 0]*cs+cs-1)), 0)
+        dj = np.maximum(np.maximum(keys[:, 1]*cs - j, j - (keys[:, 1]*cs+cs-1)), 0)
+        bounds = di**2 + dj**2
+        best, nearest = None, None
+        for k in np.argsort(bounds, kind='stable'):
+            if best is not None and bounds[k] > best:
+                break
+            ci, cj = keys[k]
+            i0, j0 = ci*cs, cj*cs
+            cells = self.map[self.get_layers(layer), i0:i0+self.rows[ci], j0:j0+self.cols[cj]]
+            rows, cols = np.nonzero((cells == tile).any(axis=0))
+            distance = (rows+i0-i)**2 + (cols+j0-j)**2
+            near = np.argmin(distance)
+            if best is None or distance[near] < best:
+                best, nearest = int(distance[near]), (int(rows[near]+i0), int(cols[near]+j0))
+        return nearest
+
+    def get_memory(self):
+        return self.table.nbytes + self.counts.nbytes + self.counted.nbytes
+
+
 class Tilemap:
+
+    surface_budget = 64 # chunk surfaces kept between frames
+    save_path = 'game_1/save/'
+
     def __init__(self, tileset, size=(32, 32), grid_activate=True, resize = 1):
         self.resize = resize
         self.sprite_size = size
         self.tileset = tileset
-        self.save = []
+        self.journal = Journal()
+        self.dirty = []
+        self.damage = None
         self.overlay = 0
+        self.view = (0, 0)
         self.grid_activate = grid_activate
+        self.dtype = tileset.get_dtype()
+        self.map = Chunkmap(size, dtype=self.dtype)
+        self.index = TileIndex(self.map)
 
+        self.grids = OrderedDict()
         self.set_surface()
 
     def set_scale(self, resize):
@@ -193,188 +1164,855 @@ class Tilemap:
         self.render()
 
     def set_surface(self):
+        # chunk surfaces are built on first display, see get_surface
+        self.surfaces = OrderedDict()
+
+    def get_surface(self, key):
+        # composite of the chunk, above one cached surface per non-empty layer
+        if key in self.surfaces:
+            self.surfaces.move_to_end(key)
+            return self.surfaces[key][0]
+
+        start = profiler.start()
+        ci, cj = key
+        cs = self.map.chunk_size
+        composite = self.new_surface(key)
+        self.surfaces[key] = [composite, [None]*self.map.shape[0]]
+
+        i0, j0, i1, j1 = self.clip(ci*cs, cj*cs, (ci+1)*cs, (cj+1)*cs)
+        if i0 < i1 and j0 < j1:
+            for layer, cells in enumerate(self.map[:, i0:i1, j0:j1]):
+                self.draw_layer(key, layer, cells, i0, j0)
+            self.draw(key, i0, j0, i1, j1, ())
+        profiler.stop('Tilemap.get_surface', start)
+        return composite
+
+    def new_surface(self, key):
+        cs = self.map.chunk_size
+        surface = pygame.Surface(self.get_rect(key[0]*cs, key[1]*cs, (key[0]+1)*cs, (key[1]+1)*cs).size).convert_alpha()
+        surface.fill((0, 0, 0, 0))
+        return surface
+
+    def render(self):
+
+        if profiler.enabled:
+            profiler.count('render')
+        self.surfaces.clear()
+        self.dirty = []
+        self.damage = None
+
+    def update(self):
+
+        start = profiler.start()
+        for i0, j0, i1, j1, layers in self.dirty:
+            for key, cells in self.map.get_chunks(i0, j0, i1, j1):
+                if key in self.surfaces:
+                    self.draw(key, *cells, layers)
+        self.dirty = []
+        profiler.stop('Tilemap.update', start)
+
+    def draw(self, key, i0, j0, i1, j1, layers=None):
+        # redraw the cells of the given layers (all if None), then composite them
+
+        if i0 >= i1 or j0 >= j1:
+            return
+
+        composite, surfaces = self.surfaces[key]
+        layers = range(self.map.shape[0]) if layers is None else layers
+        for layer in layers:
+            self.draw_layer(key, layer, self.map[layer, i0:i1, j0:j1], i0, j0)
+
+        cs = self.map.chunk_size
+        x0, y0 = self.get_rect(key[0]*cs, key[1]*cs, 0, 0).topleft
+        rect = self.get_rect(i0, j0, i1, j1).move(-x0, -y0)
+        composite.set_clip(rect)
+        composite.fill((0, 0, 0, 0), rect)
+        composite.blits([(surface, rect.topleft, rect) for surface in surfaces if surface is not None], doreturn=False)
+        composite.set_clip(None)
+
+    def draw_layer(self, key, layer, cells, i0, j0):
+
+        surfaces = self.surfaces[key][1]
+        if layer >= len(surfaces):
+            surfaces.extend([None]*(layer+1-len(surfaces)))
+
+        empty = self.map.fill
+        surface = surfaces[layer]
+        if surface is None:
+            if (cells == empty).all():
+                return
+            surface = surfaces[layer] = self.new_surface(key)
+
+        tiles = self.tileset.get_scale(self.resize)
+        w, h = self.tileset.sprite_size
+        cs = self.map.chunk_size
+        x0, y0 = self.get_rect(key[0]*cs, key[1]*cs, 0, 0).topleft
+        columns = [ceil(j*w*self.resize)-x0 for j in range(j0, j0+cells.shape[1]+1)]
+        areas = [(0, 0, x1-x, tiles.size[1]) for x, x1 in zip(columns, columns[1:])]
+
+        rect = self.get_rect(i0, j0, i0+cells.shape[0], j0+cells.shape[1]).move(-x0, -y0)
+        surface.set_clip(rect)
+        surface.fill((0, 0, 0, 0), rect)
+        # the cells are cleared: max copies the tile pixels as they are, alpha
+        # included, so that layers blend only once, when composited
+        for i, row in enumerate(cells.tolist(), i0):
+            y = ceil(i*h*self.resize)-y0
+            surface.set_clip(rect.clip((rect.left, y, rect.width, ceil((i+1)*h*self.resize)-y0-y)))
+            blits = [(tiles[tile], (x, y), area, BLEND_RGBA_MAX) for x, area, tile in zip(columns, areas, row) if tile != empty]
+            surface.blits(blits, doreturn=False)
+            if profiler.enabled:
+                profiler.count('tiles', len(blits))
+        surface.set_clip(None)
+
+    def blit(self, screen):
+
+        start = profiler.start()
+        cs = self.map.chunk_size
+        x, y = self.get_rect(*self.view, 0, 0).topleft
+        i0, j0, i1, j1 = self.get_view(screen.get_size())
+        self.map.set_view(j0, j1)
+
+        visible = 0
+        if i0 < i1 and j0 < j1:
+            for key, _ in self.map.get_chunks(i0, j0, i1, j1):
+                position = self.get_rect(key[0]*cs, key[1]*cs, 0, 0).topleft
+                screen.blit(self.get_surface(key), (position[0]-x, position[1]-y))
+                visible += 1
+            if self.grid_activate:
+                self.blit_grid(screen, i0, j0, i1, j1)
+
+        while len(self.surfaces) > max(self.surface_budget, visible):
+            self.surfaces.popitem(last=False)
+        profiler.stop('Tilemap.blit', start)
+
+    def blit_tiles(self, screen):
+        # draw only the cells under the view, straight from the tile cache
+        start = profiler.start()
+        i0, j0, i1, j1 = self.get_view(screen.get_size())
+        self.map.set_view(j0, j1)
+        if i0 >= i1 or j0 >= j1:
+            return
+
+        tiles = self.tileset.get_scale(self.resize)
+        w, h = self.tileset.sprite_size
+        x0, y0 = self.get_rect(*self.view, 0, 0).topleft
+        columns = [ceil(j*w*self.resize)-x0 for j in range(j0, j1+1)]
+        # a tile is cut to its cell, as in draw_layer: at a fractional zoom it
+        # is one pixel wider or taller than the cell
+        areas = [(0, 0, x1-x, tiles.size[1]) for x, x1 in zip(columns, columns[1:])]
+
+        empty = self.map.fill
+        clip = screen.get_clip()
+        for layer in self.map[:, i0:i1, j0:j1]:
+            for i, row in enumerate(layer.tolist(), i0):
+                y = ceil(i*h*self.resize)-y0
+                screen.set_clip(clip.clip((clip.left, y, clip.width, ceil((i+1)*h*self.resize)-y0-y)))
+                blits = [(tiles[tile], (x, y), area) for x, area, tile in zip(columns, areas, row) if tile != empty]
+                screen.blits(blits, doreturn=False)
+                if profiler.enabled:
+                    profiler.count('tiles', len(blits))
+        screen.set_clip(clip)
 
-        h, w = self.sprite_size
-        self.image = pygame.Surface(
-            (ceil(self.tileset.sprite_size[0]*w*self.resize), ceil(self.tileset.sprite_size[1]*h*self.resize))).convert_alpha()
-        
-        self.rect = self.image.get_rect()
-
-    def render(self, save_activate=True):
-
-        self.image.fill((0, 0, 0, 0))
-
-        for mask in range(self.map.shape[0]):
-            m, n = self.map.shape[1:3]
-            for i in range(m):
-                for j in range(n):
-                    tile = pygame.transform.scale(self.tileset.tiles[self.map[mask][i, j]], (ceil(self.tileset.sprite_size[0]*self.resize), ceil(self.tileset.sprite_size[1]*self.resize)))
-                    self.image.blit(tile, (ceil(j*self.tileset.sprite_size[0]*self.resize), ceil(i*self.tileset.sprite_size[0]*self.resize)))
-                    
         if self.grid_activate:
-            self.grid()
+            self.blit_grid(screen, i0, j0, i1, j1)
+        profiler.stop('Tilemap.blit_tiles', start)
+
+    def blit_grid(self, screen, i0, j0, i1, j1):
+        # the grid is drawn over the tiles at display time, clipped to the map
+        x, y = self.get_rect(*self.view, 0, 0).topleft
+        surface, origin = self.get_grid(screen.get_size(), i0, j0)
+        position = self.get_rect(*origin, 0, 0).topleft
+
+        clip = screen.get_clip()
+        rect = self.get_rect(i0, j0, i1, j1).move(-x, -y)
+        # one more pixel for the closing lines, on the far edges of the map
+        screen.set_clip(pygame.Rect(rect.topleft, (rect.width+1, rect.height+1)).clip(clip))
+        screen.blit(surface, (position[0]-x, position[1]-y))
+        screen.set_clip(clip)
+
+    def get_grid(self, size, i0, j0):
+        # one transparent grid surface per zoom level, reused while scrolling
+        # when a whole number of tiles spans a whole number of pixels
+        w, h = self.tileset.sprite_size
+        pi, pj = self.get_period(h), self.get_period(w)
+        origin = (i0 - i0 % pi if pi else i0, j0 - j0 % pj if pj else j0)
+        key = (self.resize, size, None if pi else origin[0], None if pj else origin[1])
+
+        if key in self.grids:
+            self.grids.move_to_end(key)
+            return self.grids[key], origin
+
+        start = profiler.start()
+        rows = ceil(size[1]/(h*self.resize)) + (pi or 1)
+        cols = ceil(size[0]/(w*self.resize)) + (pj or 1)
+        rect = self.get_rect(*origin, origin[0]+rows, origin[1]+cols)
+        surface = pygame.Surface((rect.width+1, rect.height+1)).convert_alpha()
+        surface.fill((0, 0, 0, 0))
+        self.grid(surface, rect.topleft, *origin, origin[0]+rows, origin[1]+cols)
+        profiler.stop('Tilemap.get_grid', start)
+
+        self.grids[key] = surface
+        while len(self.grids) > self.tileset.cache_size:
+            self.grids.popitem(last=False)
+        return surface, origin
+
+    def get_period(self, size):
+        # smallest number of tiles covering a whole number of pixels
+        for period in range(1, self.map.chunk_size+1):
+            if abs(period*size*self.resize - round(period*size*self.resize)) < 1e-6:
+                return period
+        return None
+
+    def get_view(self, size):
+        w, h = self.tileset.sprite_size
+        x, y = self.get_rect(*self.view, 0, 0).topleft
+        width, height = size
+        return self.clip(floor(y/(h*self.resize)), floor(x/(w*self.resize)),
+                         ceil((y+height)/(h*self.resize)), ceil((x+width)/(w*self.resize)))
+
+    def clip(self, i0, j0, i1, j1):
+        return self.map.clip(i0, j0, i1, j1)
+
+    def set_dirty(self, i0, j0, i1, j1, layers=None):
+        i0, j0, i1, j1 = self.clip(i0, j0, i1, j1)
+        if i0 < i1 and j0 < j1:
+            self.dirty.append((i0, j0, i1, j1, layers))
+            if self.damage is not None:
+                self.damage.append((i0, j0, i1, j1))
+
+    def get_damage(self):
+        # screen rects changed since the last call, None if it all changed
+        damage, self.damage = self.damage, []
+        if damage is None:
+            return None
+        x, y = self.get_rect(*self.view, 0, 0).topleft
+        return [self.get_rect(*cells).move(-x, -y) for cells in damage]
+
+    def get_rect(self, i0, j0, i1, j1):
+        w, h = self.tileset.sprite_size
+        x0, y0 = ceil(j0*w*self.resize), ceil(i0*h*self.resize)
+        x1, y1 = ceil(j1*w*self.resize), ceil(i1*h*self.resize)
+        return pygame.Rect(x0, y0, x1-x0, y1-y0)
+
+    def get_size(self):
+        return self.get_rect(0, 0, *self.map.shape[1:3]).size
+
+    def set_map(self, chunkmap):
+        if isinstance(self.map, Streammap) or isinstance(chunkmap, Streammap):
+            # the history does not carry over between an infinite world and a finite map
+            self.journal = Journal()
+        else:
+            self.journal.add_map(self.map.get_state(), chunkmap.get_state())
+        if isinstance(self.map, Streammap):
+            self.map.close()
+        self.map = chunkmap
+        self.set_index()
+        self.render()
 
-        if save_activate:
-            self.save_local()
+    def set_index(self):
+        # an infinite world is not indexed: its chunks come and go
+        self.index = None if isinstance(self.map, Streammap) else TileIndex(self.map)
+
+    def set_stream(self, seed = None):
+        seed = np.random.randint(0, 10000) if seed is None else seed
+        self.set_map(Streammap(self.sprite_size[0], seed, dtype=self.dtype))
+        print(seed)
 
     def set_reset(self):
-        self.map = np.array([np.full(self.sprite_size, 602, dtype=int)])
-        self.render()
+        self.set_map(Chunkmap(self.sprite_size, dtype=self.dtype))
 
     def set_random(self):
-        n = len(self.tileset.tiles)
-        self.map = np.array([np.random.randint(n, size=self.sprite_size)])
-        self.render()
+        n = len(self.tileset)
+        self.set_map(Chunkmap.from_array(np.array([np.random.randint(n, size=self.sprite_size)]), dtype=self.dtype))
 
     def set_enumerate(self):
-        self.map = np.array([np.arange(0, self.sprite_size[0]*self.sprite_size[1], dtype=int).reshape(self.sprite_size)])
-        self.render()
+        self.set_map(Chunkmap.from_array(np.array([np.arange(0, self.sprite_size[0]*self.sprite_size[1]).reshape(self.sprite_size)]), dtype=self.dtype))
 
     def set_modify(self, tiles_pos, tile):
-        for tile_pos in tiles_pos:
-            self.map[tile_pos] = tile
-        self.render()
+        if not len(tiles_pos):
+            return
+        mask, i, j = np.unique(np.array(tiles_pos), axis=0).T
+        old = self.map[mask, i, j]
+        self.journal.add_cells(mask, i, j, old, tile)
+        self.map[mask, i, j] = tile
+        self.set_count(mask, i, j, old, tile)
+        self.set_dirty(i.min(), j.min(), i.max()+1, j.max()+1, np.unique(mask).tolist())
+        self.update()
+
+    def set_block(self, layer, i0, j0, block, old=None):
+        # one slice write, one undo record, one dirty rect
+        i1, j1 = i0+block.shape[0], j0+block.shape[1]
+        old = self.map[layer, i0:i1, j0:j1] if old is None else old
+        self.journal.add_block(layer, i0, j0, old, block)
+        self.map[layer, i0:i1, j0:j1] = block
+        rows, cols = np.nonzero(old != block)
+        self.set_count(layer, rows+i0, cols+j0, old[rows, cols], block[rows, cols])
+        self.set_dirty(i0, j0, i1, j1, [layer])
+        self.update()
+
+    def set_rect(self, layer, i0, j0, i1, j1, tile):
+        i0, j0, i1, j1 = self.clip(i0, j0, i1, j1)
+        if i0 < i1 and j0 < j1:
+            self.set_block(layer, i0, j0, np.full((i1-i0, j1-j0), tile, dtype=self.map.dtype))
+
+    def set_replace(self, layer, i0, j0, i1, j1, old, new):
+        # tile old becomes new inside the rectangle
+        i0, j0, i1, j1 = self.clip(i0, j0, i1, j1)
+        if i0 < i1 and j0 < j1:
+            block = self.map[layer, i0:i1, j0:j1]
+            block[block == old] = new
+            self.set_block(layer, i0, j0, block)
+
+    def set_stamp(self, layer, i, j, pattern, transparent=None):
+        # pattern pasted with its top left corner on (i, j), cut at the map
+        # edges; its cells equal to transparent leave the map as it is
+        pattern = np.asarray(pattern)
+        i0, j0, i1, j1 = self.clip(i, j, i+pattern.shape[0], j+pattern.shape[1])
+        if i0 < i1 and j0 < j1:
+            pattern = pattern[i0-i:i1-i, j0-j:j1-j]
+            block = self.map[layer, i0:i1, j0:j1]
+            if transparent is None:
+                block[:] = pattern
+            else:
+                block[pattern != transparent] = pattern[pattern != transparent]
+            self.set_block(layer, i0, j0, block)
+
+    def set_line(self, layer, start, end, tile):
+        # cells crossed by the segment, one per step along its longest axis
+        (i0, j0), (i1, j1) = start, end
+        n = max(abs(i1-i0), abs(j1-j0)) + 1
+        i = np.rint(np.linspace(i0, i1, n)).astype(np.int64)
+        j = np.rint(np.linspace(j0, j1, n)).astype(np.int64)
+        c0, d0, c1, d1 = self.clip(min(i0, i1), min(j0, j1), max(i0, i1)+1, max(j0, j1)+1)
+        inside = (i >= c0) & (i < c1) & (j >= d0) & (j < d1)
+        i, j = i[inside], j[inside]
+        if len(i):
+            old = self.map[layer, i, j]
+            self.journal.add_cells(layer, i, j, old, tile)
+            self.map[layer, i, j] = tile
+            self.set_count(layer, i, j, old, tile)
+            self.set_dirty(i.min(), j.min(), i.max()+1, j.max()+1, [layer])
+            self.update()
+
+    def set_fill(self, layer, i, j, tile, connectivity=4, region=None):
+        # paint bucket: the cells connected to (i, j) holding its tile become
+        # tile; returns the changed rectangle, None if nothing changed
+        if region is None:
+            region = (0, 0, *self.map.shape[1:])
+            if isinstance(self.map, Streammap):
+                # an infinite world is filled within the columns in memory
+                if not self.map.columns:
+                    return None
+                cs = self.map.chunk_size
+                region = (0, min(self.map.columns)*cs, self.map.shape[1], (max(self.map.columns)+1)*cs)
+        i0, j0, i1, j1 = self.clip(*region)
+        if not (i0 <= i < i1 and j0 <= j < j1):
+            return None
+        cells = self.map[layer, i0:i1, j0:j1]
+        if cells[i-i0, j-j0] == tile:
+            return None
+
+        rows, cols = self.get_region(cells == cells[i-i0, j-j0], i-i0, j-j0, connectivity)
+        r0, c0, r1, c1 = rows.min(), cols.min(), rows.max()+1, cols.max()+1
+        block = cells[r0:r1, c0:c1].copy()
+        block[rows-r0, cols-c0] = tile
+        self.set_block(layer, i0+r0, j0+c0, block, cells[r0:r1, c0:c1])
+        return int(i0+r0), int(j0+c0), int(i0+r1), int(j0+c1)
+
+    def set_count(self, layer, rows, cols, old, new):
+        if self.index is not None:
+            self.index.update(layer, rows, cols, old, new)
+
+    def get_index(self):
+        if self.index is None:
+            raise ValueError('an infinite world has no tile index: save it and load it as a finite map')
+        return self.index
+
+    def get_count(self, tile, layer=None):
+        return self.get_index().get_count(tile, layer)
+
+    def get_chunks(self, tile, layer=None):
+        return self.get_index().get_chunks(tile, layer)
+
+    def get_nearest(self, tile, i, j, layer=None):
+        return self.get_index().get_nearest(tile, i, j, layer)
+
+    def get_region(self, mask, i, j, connectivity=4):
+        # cells of mask connected to (i, j), found on horizontal runs rather
+        # than cell by cell: runs of two following rows touch when they
+        # overlap, or when they are one column apart in 8-connectivity
+        if np.count_nonzero(mask[1:] & ~mask[:-1]) < np.count_nonzero(mask[:, 1:] & ~mask[:, :-1]):
+            # fewer runs along the columns, as in a vertical shaft: the same
+            # search on the transposed mask
+            cols, rows = self.get_region(mask.T, j, i, connectivity)
+            return rows, cols
+        m, n = mask.shape
+        edges = np.diff(np.pad(mask, ((0, 0), (1, 1))).astype(np.int8), axis=1)
+        run_rows, starts = np.nonzero(edges == 1)
+        ends = np.nonzero(edges == -1)[1]
+        stride = n+2
+        start_keys, end_keys = run_rows*stride + starts, run_rows*stride + ends
+
+        reach = 1 if connectivity == 8 else 0
+        low = np.searchsorted(end_keys, (run_rows+1)*stride + starts - reach, 'right')
+        high = np.searchsorted(start_keys, (run_rows+1)*stride + ends + reach, 'left')
+        count = np.maximum(high-low, 0)
+        below = np.repeat(low - np.cumsum(count) + count, count) + np.arange(count.sum())
+        above = np.repeat(np.arange(len(starts)), count)
+
+        # components of the run graph: every run points to a smaller run of
+        # its component. Each pass hooks the larger root of a link onto the
+        # smaller one, then pointer jumping flattens the trees, so a long
+        # chain of short runs takes a few passes rather than one per run
+        label = np.arange(len(starts))
+        while len(above):
+            a, b = label[above], label[below]
+            join = a != b
+            above, below, a, b = above[join], below[join], a[join], b[join]
+            np.minimum.at(label, np.maximum(a, b), np.minimum(a, b))
+            jumped = label[label]
+            while (jumped != label).any():
+                label, jumped = jumped, jumped[jumped]
+
+        seed = np.searchsorted(start_keys, i*stride + j, 'right') - 1
+        runs = np.nonzero(label == label[seed])[0]
+        length = ends[runs] - starts[runs]
+        rows = np.repeat(run_rows[runs], length)
+        cols = np.repeat(starts[runs] - np.cumsum(length) + length, length) + np.arange(length.sum())
+        return rows, cols
 
     def set_generator(self, seed = np.random.randint(0,10000)):
-        self.set_reset()
-
-        map_generator = generator(self.map, seed)
-        self.map = map_generator.map
 
-        self.render()
+        map_generator = generator(np.array([np.full(self.sprite_size, 602, dtype=self.dtype)]), seed, os.cpu_count())
+        self.set_map(Chunkmap.from_array(map_generator.map))
+        print(seed)
 
     def set_overlay(self, overlay):
+        # a new layer is filled with the empty tile: no cell to redraw
         self.overlay += overlay
         if self.overlay >= self.map.shape[0]:
-            self.map = np.append(self.map, [np.full(self.sprite_size, 602, dtype=int)], axis=0)
+            self.journal.add_layers(self.map.shape[0], self.overlay+1)
+            self.set_layers(self.overlay+1)
             print(self.map.shape)
 
-    def grid(self):
-        m, n = self.map.shape[1:3]
-        x, y = self.image.get_size()
-        for i in range(m+1):
-            pygame.draw.line(self.image, (255, 255, 255),
-                             (0, y/m*i), (x, y/m*i))
-        for j in range(n):
-            pygame.draw.line(self.image, (255, 255, 255),
-                             (x/n*j, 0), (x/n*j, y))
+    def set_layers(self, layers):
+        # layers are only added or dropped empty, see Journal.add_layers
+        while self.map.shape[0] < layers:
+            self.map.add_layer()
+            if self.index is not None:
+                self.index.add_layer()
+        while self.map.shape[0] > layers:
+            self.map.remove_layer()
+            if self.index is not None:
+                self.index.remove_layer()
+            for composite, surfaces in self.surfaces.values():
+                del surfaces[layers:]
+        self.overlay = min(self.overlay, layers-1)
+
+    def grid(self, surface, origin, i0, j0, i1, j1):
+        # lines on the tile edges, as placed by get_rect
+        w, h = self.tileset.sprite_size
+        x0, y0 = origin
+        x1, y1 = ceil(j1*w*self.resize)-x0, ceil(i1*h*self.resize)-y0
+        for i in range(i0, i1+1):
+            y = ceil(i*h*self.resize)-y0
+            pygame.draw.line(surface, (255, 255, 255), (0, y), (x1, y))
+        for j in range(j0, j1+1):
+            x = ceil(j*w*self.resize)-x0
+            pygame.draw.line(surface, (255, 255, 255), (x, 0), (x, y1))
 
     def get_pos(self):
         pos = pygame.mouse.get_pos()
-        return int(pos[1]/self.rect.height * self.sprite_size[0]//1), int(pos[0]/self.rect.width * self.sprite_size[1]//1)
-
-    def save_local(self):
-        self.save.append(self.map.tolist())
+        w, h = self.tileset.sprite_size
+        x, y = self.get_rect(*self.view, 0, 0).topleft
+        return int((pos[1]+y)//(h*self.resize)), int((pos[0]+x)//(w*self.resize))
+
+    def get_memory(self):
+        # bytes held by the map, its history and its display
+        chunks, packed = self.map.get_memory()
+        return {
+            'map': chunks,
+            'packed': packed,
+            'undo': self.journal.get_memory(),
+            'surfaces': sum(surface.get_pitch()*surface.get_height()
+                            for composite, layers in self.surfaces.values()
+                            for surface in [composite, *layers] if surface is not None),
+            'grid': sum(surface.get_pitch()*surface.get_height() for surface in self.grids.values()),
+            'index': 0 if self.index is None else self.index.get_memory(),
+            'tiles': self.tileset.get_memory(),
+        }
 
     def back(self):
-        if len(self.save) > 1:
-            np.array(self.save.pop())
-            self.map = np.array(self.save.pop())
+        record = self.journal.undo()
+        if record is not None:
+            kind, *data, old, new = record
+            self.set_record(kind, data, old)
+
+    def forward(self):
+        record = self.journal.forward()
+        if record is not None:
+            kind, *data, old, new = record
+            self.set_record(kind, data, new)
+
+    def set_record(self, kind, data, value):
+        if kind == 'map':
+            self.map = Chunkmap.from_state(value)
+            self.set_index()
+            self.overlay = min(self.overlay, self.map.shape[0]-1)
             self.render()
-
-    def new_save(self):
-        name = input('name: ')
-        np.save('game_1/save/'+name+'.npy', self.map)
-
-    def get_save(self):
-        name = input('name: ')
-        self.map = np.load('game_1/save/'+name+'.npy')
-        self.render()
+            return
+        if kind == 'layers':
+            self.set_layers(value)
+            return
+
+        mask, i, j = data[0]
+        old = self.map[mask, i, j]
+        self.map[mask, i, j] = value
+        self.set_count(mask, i, j, old, value)
+        self.set_dirty(i.min(), j.min(), i.max()+1, j.max()+1, np.unique(mask).tolist())
+        self.update()
+
+    def new_save(self, name=None):
+        name = input('name: ') if name is None else name
+        os.makedirs(self.save_path, exist_ok=True)
+        self.map.save(self.save_path+name+'.map')
+
+    def get_save(self, name=None):
+        name = input('name: ') if name is None else name
+        path = self.save_path+name
+        if os.path.exists(path+'.map'):
+            self.set_map(Chunkmap.load(path+'.map'))
+        else:
+            # old save, a single array
+            self.set_map(Chunkmap.from_array(np.load(path+'.npy'), dtype=self.dtype))
 
     def __str__(self):
         return f'{self.__class__.__name__} {self.sprite_size}'
 
+class Noise:
+
+    # gradient noise (1D Perlin) over several octaves, computed at once on an
+    # array of columns: each column only depends on the seed
+
+    def __init__(self, random, purpose, scale, octaves=4, persistence=0.5):
+        self.random = random # hashed draw (x, y, purpose) -> [0, 1), see generator.random
+        self.purpose = purpose
+        self.scale = scale # columns per period of the first octave
+        self.octaves = octaves
+        self.persistence = persistence
+
+    def __call__(self, x):
+        # values in [-1, 1]
+        x = np.asarray(x, dtype=np.float64)/self.scale
+        total = np.zeros(x.shape)
+        amplitude = norm = 1.0
+        for octave in range(self.octaves):
+            total += amplitude*self.gradient(x*2**octave, octave)
+            amplitude *= self.persistence
+            norm += amplitude
+        return total/(norm-amplitude)
+
+    def gradient(self, x, octave):
+        i = np.floor(x)
+        f = x - i
+        i = i.astype(np.int64)
+        g0 = self.random(i, octave, self.purpose)*2-1
+        g1 = self.random(i+1, octave, self.purpose)*2-1
+        t = f*f*f*(f*(f*6-15)+10)
+        # slope g0 on the left, g1 on the right: at most 1/2 in absolute value
+        return 2*(g0*f + t*(g1*(f-1) - g0*f))
+
+
+class Prefab:
+
+    # structure compiled once into numpy masks: tiles and priorities
+    registry = {}
+    priorities = {420: 1, 425: 1, 200: 2, 243: 2} # leaves, then roots; 3 for the rest
+
+    def __init__(self, pattern, empty=602):
+        # pattern: rows from the top down to the root, [offset, tile]
+        left = min(dx for row in pattern for dx, tile in row)
+        right = max(dx for row in pattern for dx, tile in row)
+        self.tile = np.full((len(pattern), right-left+1), empty, dtype=np.int64)
+        self.priority = np.zeros(self.tile.shape, dtype=np.int8) # 0: cell left as it is
+        for y, row in enumerate(pattern):
+            for dx, tile in row:
+                self.tile[y, dx-left] = tile
+                self.priority[y, dx-left] = self.priorities.get(tile, 3)
+        self.anchor = (len(pattern)-1, -left) # the root
+
+        # cells placed, relative to the root
+        rows, cols = np.nonzero(self.priority)
+        self.rows, self.cols = rows-self.anchor[0], cols-self.anchor[1]
+        self.tiles, self.ranks = self.tile[rows, cols], self.priority[rows, cols]
+
+    @classmethod
+    def register(cls, name, pattern):
+        cls.registry[name] = cls(pattern)
+        return cls.registry[name]
+
+    @classmethod
+    def place(cls, layer, placements):
+        # every structure at once: placements is a list of (name, columns,
+        # rows) of the roots in layer. What falls outside layer is cut; on a
+        # shared cell the highest priority wins, then the leftmost structure
+        m, n = layer.shape
+        parts = []
+        for name, x, y in placements:
+            prefab = cls.registry[name]
+            x, y = np.asarray(x, dtype=np.int64)[:, None], np.asarray(y, dtype=np.int64)[:, None]
+            shape = (len(x), len(prefab.tiles))
+            parts.append((np.broadcast_to(y + prefab.rows, shape).ravel(), np.broadcast_to(x + prefab.cols, shape).ravel(),
+                          np.broadcast_to(prefab.tiles, shape).ravel(), np.broadcast_to(prefab.ranks, shape).ravel(),
+                          np.broadcast_to(x, shape).ravel()))
+        if not parts:
+            return
+        rows, cols, tiles, ranks, order = (np.concatenate(part) for part in zip(*parts))
+
+        inside = (rows >= 0) & (rows < m) & (cols >= 0) & (cols < n)
+        rows, cols, tiles, ranks, order = rows[inside], cols[inside], tiles[inside], ranks[inside], order[inside]
+        cells = rows*n + cols
+        sort = np.lexsort((order, -ranks, cells))
+        first = sort[np.unique(cells[sort], return_index=True)[1]]
+        layer[rows[first], cols[first]] = tiles[first]
+
+
 class generator:
-    def __init__(self, map = np.array([np.full((256, 16), 602, dtype=int)]), seed = np.random.randint(9999999)):
+
+    start = 70 # mean row of the surface, from the bottom of the map
+    relief = 24 # largest gap between the surface and its mean row
+    sea = 63 # sea level, from the bottom of the map
+
+    shard = 256 # columns per shard
+    tree_reach = 2 # width of the leaves on each side of the trunk
+    iron_coef = 0.01
+    coal_coef = 0.03
+    diamond_coef = 0.001
+    ores = {'iron': 395, 'coal': 161, 'diamond': 168}
+    cave_coef = 0.42 # share of air drawn before the caves are smoothed
+    cave_steps = 4 # automaton steps, and margin in columns of each shard
+    cave_wall = 5 # a cell becomes stone with at least this many stones in its 3x3 block
+
+    # biome: surface, subsurface, surface water, tree and its density, plants (tile, density)
+    biomes = {
+        'plain': {'surface': 332, 'subsurface': 200, 'water': 2, 'tree': 'plain', 'trees': 0.04,
+                  'plants': [(214, 0.2), (79, 0.03), (207, 0.03)]},
+        'forest': {'surface': 332, 'subsurface': 200, 'water': 2, 'tree': 'plain', 'trees': 0.3,
+                   'plants': [(214, 0.1)]},
+        'desert': {'surface': 243, 'subsurface': 243, 'water': 2, 'tree': 'cactus', 'trees': 0.04,
+                   'plants': [(225, 0.04)]},
+        'tundra': {'surface': 334, 'subsurface': 200, 'water': 392, 'tree': 'spruce', 'trees': 0.1,
+                   'plants': []},
+    }
+
+    # tree patterns, rows from the top down to the root: [offset, tile]
+    trees = {
+        'plain': [
+            [[-1, 420,], [0, 420,], [1, 420,]],
+            [[-2, 420,],[-1, 420,],[0, 451], [1, 420,], [2, 420,]],
+            [[-2, 420,],[-1, 420,],[0, 451], [1, 420,], [2, 420,]],
+            [[0, 451]],
+            [[0, 451]],
+            [[0, 200]]
+        ],
+        'spruce': [
+            [[0, 425]],
+            [[-1, 425], [0, 425], [1, 425]],
+            [[0, 453]],
+            [[-2, 425], [-1, 425], [0, 453], [1, 425], [2, 425]],
+            [[0, 453]],
+            [[0, 453]],
+            [[0, 200]]
+        ],
+        'cactus': [
+            [[0, 38]],
+            [[0, 38]],
+            [[0, 38]],
+            [[0, 243]]
+        ],
+    }
+
+    def __init__(self, map = np.array([np.full((256, 16), 602, dtype=np.uint16)]), seed = np.random.randint(9999999), workers = 1, origin = 0):
         self.map = map
         self.seed = seed
         self.map_size = map.shape[1:]
-        self.plain()
-        print(self.seed)
-        pass
-
-    def random_seed(self, pos):
-
-        x = pos[0]
-        y = pos[1]
-        self.seed += x+y
-        np.random.seed(self.seed)
-
-        return np.random.random()
-
-    def plain(self):
-
-        offset =  256
-        lissage = 256
-        couche = 255-70 #init couche de départ
-
-        iron_coef = 0.01
-        coal_coef = 0.03
-        diamond_coef = 0.001
-
-
-        for x in range(self.map_size[1]):
-
-            rand = self.random_seed((x,ceil(couche)))
-
-            if couche >= 256-63:
-                self.map[0, ceil(couche), x] = 200
-            else:
-                self.map[0, ceil(couche), x] = 332
-
-            if rand < 0.1:
-                self.tree((x, ceil(couche)), "plain")
-
-            couche += np.random.randint(-offset,offset+1)/lissage
-
-
-        for x in range(self.map_size[1]):
-            for y in range(1, self.map_size[0]):
-                if self.map[0,y-1, x] == 332 or self.map[0,y-1, x] == 200:
-                    self.random_seed((x,y))
-                    for n in range(0, np.random.randint(2,4)):
-                        self.map[0, y+n, x] = 200
-                    break
-
-        for x in range(self.map_size[1]):
-            for y in range(1, self.map_size[0]):
-                if self.map[0,y-1, x] == 200:
-                    if self.map[0,y,x] != 200:
-                        for n in range(self.map_size[0]-y):
-                            rand = self.random_seed((x,y))
-                            if rand < iron_coef and y+n > 255-60:
-                                self.map[0,y+n,x] = 395
-                            elif iron_coef < rand < iron_coef+coal_coef and y+n > 255-130:
-                                self.map[0,y+n,x] = 161
-                            elif iron_coef+coal_coef < rand < diamond_coef+iron_coef+coal_coef and y+n > 255-15:
-                                self.map[0,y+n,x] = 168
-                            else:
-                                self.map[0,y+n,x] = 308
-                        break
-        
-        for x in range(self.map_size[1]):
-            for y in range(255-62, self.map_size[0]):
-                if self.map[0, y, x] == 602 :
-                    self.map[0,y, x] = 2
-    
-    def tree(self, pos, type = np.random.choice(("plain", "other"))):
-        if type == "plain":
-            tree = [
-                        [[-1, 420,], [0, 420,], [1, 420,]],
-                        [[-2, 420,],[-1, 420,],[0, 451], [1, 420,], [2, 420,]],
-                        [[-2, 420,],[-1, 420,],[0, 451], [1, 420,], [2, 420,]],
-                        [[0, 451]],
-                        [[0, 451]],
-                        [[0, 200]]
-                    ]
-
-        print("ok")
-        for y in range(len(tree)):
-            for x in tree[y]:
-                if 0 <= pos[0]+x[0] < self.map_size[1]:
-                    if self.map[0, pos[1]+y-len(tree)+1, pos[0]+x[0]] != 420 or x[1] == 451:
-                        self.map[0, pos[1]+y-len(tree)+1, pos[0]+x[0]] = x[1]
-
-
-game = Game()
-game.run()
+        self.origin = origin # world column of column 0 of map
+
+        self.noise = {
+            'height': Noise(self.random, 'height', 128, 5),
+            'temperature': Noise(self.random, 'temperature', 1024, 2),
+            'humidity': Noise(self.random, 'humidity', 512, 2),
+        }
+
+        # each column only depends on its position: any region is generated
+        # on its own and the shards join up
+        start = profiler.start()
+        r = self.tree_reach
+        columns = np.arange(origin-r, origin+self.map_size[1]+r)
+        self.height = self.get_height(columns)
+        self.depth = self.height + self.randint(2, 4, columns, 0, 'dirt')
+        self.biome = self.get_biome(columns)
+        profiler.stop('generator.height', start)
+
+        n = self.map_size[1]
+        shards = [(x, min(x+self.shard, n)) for x in range(0, n, self.shard)]
+        if workers > 1 and len(shards) > 1:
+            # numpy releases the GIL: each shard writes straight into self.map
+            with ThreadPoolExecutor(workers) as executor:
+                list(executor.map(lambda shard: self.plain(*shard), shards))
+        else:
+            for shard in shards:
+                self.plain(*shard)
+        profiler.stop('generator', start)
+
+    def random(self, x, y, purpose):
+        # hash of (seed, x, y, purpose): same cell, same draw, in any order
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=np.int64), np.asarray(y, dtype=np.int64))
+        key = np.uint64((int(self.seed)*0x9E3779B97F4A7C15 + zlib.crc32(purpose.encode())) % 2**64)
+
+        with np.errstate(over='ignore'):
+            h = self.mix(key + x.astype(np.uint64)*np.uint64(0xD1B54A32D192ED03))
+            h = self.mix(h + y.astype(np.uint64)*np.uint64(0xABC98388FB8FAC03))
+        return (h >> np.uint64(11)) * 2.0**-53
+
+    def mix(self, h):
+        # splitmix64 finalizer
+        h = (h ^ (h >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return h ^ (h >> np.uint64(31))
+
+    def randint(self, low, high, x, y, purpose):
+        return low + np.floor(self.random(x, y, purpose)*(high-low)).astype(int)
+
+    def plain(self, x0=0, x1=None):
+        # a shard of columns: surface, plants, trees, subsurface, stone, water, caves
+        x1 = self.map_size[1] if x1 is None else x1
+        r = self.tree_reach
+        layer = self.map[0, :, x0:x1]
+        height, depth, biome = self.height[x0+r:x1+r], self.depth[x0+r:x1+r], self.biome[x0+r:x1+r]
+        start = profiler.start()
+        self.set_surface(layer, height, biome)
+        self.set_plants(layer, self.origin+x0, height, biome)
+        start = profiler.stop('generator.surface', start)
+
+        # trees of the nearby columns reaching into the shard, all placed at once
+        m = self.map_size[0]
+        columns = np.arange(self.origin+x0-r, self.origin+x1+r)
+        density = self.get_rule('trees')[self.biome[x0:x1+2*r]]
+        land = self.height[x0:x1+2*r] < m-self.sea
+        trees = columns[(self.random(columns, 0, 'tree') < density) & land]-self.origin
+        Prefab.place(layer, [(rules['tree'], trees[self.biome[trees+r] == index]-x0, self.height[trees[self.biome[trees+r] == index]+r])
+                             for index, rules in enumerate(self.biomes.values())])
+        start = profiler.stop('generator.tree', start)
+
+        self.set_dirt(layer, height, depth, biome)
+        start = profiler.stop('generator.dirt', start)
+        self.set_stone(layer, self.origin+x0, depth)
+        start = profiler.stop('generator.stone', start)
+        self.set_water(layer, biome)
+        start = profiler.stop('generator.water', start)
+        self.set_caves(layer, self.origin+x0, depth)
+        profiler.stop('generator.cave', start)
+
+    def get_height(self, columns):
+        # row of the surface, around start
+        m = self.map_size[0]
+        couche = m-1-self.start + self.relief*self.noise['height'](columns)
+        return np.clip(np.rint(couche).astype(int), 6, m-5)
+
+    def get_biome(self, columns):
+        # index in biomes, from the temperature and humidity of each column
+        temperature = self.noise['temperature'](columns)
+        humidity = self.noise['humidity'](columns)
+        names = list(self.biomes)
+        return np.select([temperature < -0.25, (temperature > 0.25) & (humidity < 0), humidity > 0.15],
+                         [names.index('tundra'), names.index('desert'), names.index('forest')],
+                         names.index('plain'))
+
+    def get_rule(self, rule):
+        # one rule of each biome, indexed by an array of biomes
+        return np.array([biome[rule] for biome in self.biomes.values()])
+
+    def get_rows(self):
+        return np.arange(self.map_size[0])[:, None]
+
+    def set_surface(self, layer, height, biome):
+        # under the sea, the surface takes the subsurface tile
+        m = self.map_size[0]
+        tiles = np.where(height >= m-self.sea, self.get_rule('subsurface')[biome], self.get_rule('surface')[biome])
+        layer[height, np.arange(len(height))] = tiles
+
+    def set_plants(self, layer, x0, height, biome):
+        # at most one plant per column, on the surface out of the water
+        m = self.map_size[0]
+        columns = np.arange(len(height))
+        rand = self.random(np.arange(x0, x0+len(height)), 0, 'plant')
+        tiles = np.full(len(height), 602)
+        for index, rules in enumerate(self.biomes.values()):
+            low = 0
+            for tile, density in rules['plants']:
+                tiles[(biome == index) & (low <= rand) & (rand < low+density)] = tile
+                low += density
+        keep = (tiles != 602) & (height-1 < m-self.sea)
+        layer[height[keep]-1, columns[keep]] = tiles[keep]
+
+    def set_dirt(self, layer, height, depth, biome):
+        rows = self.get_rows()
+        np.copyto(layer, self.get_rule('subsurface')[biome], where=(rows > height) & (rows <= depth), casting='unsafe')
+
+    def set_stone(self, layer, x0, depth):
+        m = self.map_size[0]
+        rows = self.get_rows()
+        rand = self.random(np.arange(x0, x0+len(depth)), rows, 'ore')
+
+        iron = self.iron_coef
+        coal = iron + self.coal_coef
+        diamond = coal + self.diamond_coef
+        tiles = np.select([(rand < iron) & (rows > m-1-60),
+                           (iron < rand) & (rand < coal) & (rows > m-1-130),
+                           (coal < rand) & (rand < diamond) & (rows > m-1-15)],
+                          [self.ores['iron'], self.ores['coal'], self.ores['diamond']], 308)
+
+        np.copyto(layer, tiles, where=rows > depth, casting='unsafe')
+
+    def set_water(self, layer, biome):
+        # the top row of the sea freezes in cold biomes
+        m = self.map_size[0]
+        rows = self.get_rows()
+        np.copyto(layer, 2, where=(rows >= m-self.sea) & (layer == 602))
+        top = layer[m-self.sea]
+        np.copyto(top, self.get_rule('water')[biome], where=top == 2, casting='unsafe')
+
+    def get_caves(self, x0, x1):
+        # cellular automaton on the world columns x0..x1: each step uses up one
+        # margin column on each side, so the result does not depend on how
+        # the world is cut into shards
+        m = self.map_size[0]
+        k = self.cave_steps
+        wall = (self.random(np.arange(x0-k, x1+k), self.get_rows(), 'cave') >= self.cave_coef).astype(np.uint8)
+        for _ in range(k):
+            # above and below the map, everything is stone
+            padded = np.pad(wall, ((1, 1), (0, 0)), constant_values=1)
+            n = wall.shape[1]-2
+            count = sum(padded[di:di+m, dj:dj+n] for di in range(3) for dj in range(3))
+            wall = (count >= self.cave_wall).astype(np.uint8)
+        return wall == 0
+
+    def set_caves(self, layer, x0, depth):
+        # caves are only carved below the subsurface
+        rows = self.get_rows()
+        np.copyto(layer, 602, where=self.get_caves(x0, x0+len(depth)) & (rows > depth))
+
+    def tree(self, pos, type = "plain", x0 = 0, x1 = None):
+        # a single tree, root at pos = (column, row)
+        x1 = self.map_size[1] if x1 is None else x1
+        Prefab.place(self.map[0, :, x0:x1], [(type, [pos[0]-x0], [pos[1]])])
+
+
+for name, pattern in generator.trees.items():
+    Prefab.register(name, pattern)
+
+
+if __name__ == '__main__':
+    game = Game()
+    game.run()